@@ -1,4 +1,5 @@
 import sys
+import concurrent.futures
 import customtkinter
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
@@ -8,7 +9,8 @@ import os
 import gmc_tools
 from pathlib import Path
 import logging
-import struct
+import queue
+import threading
 
 DEFAULT_FLASH_SIZE = 1_048_576
 
@@ -42,6 +44,19 @@ class App(customtkinter.CTk):
         self.port.set(self.om1.get())
         return
 
+    def scan_ports(self):
+        """List the available serial ports in the background"""
+        self._port_future = self._port_executor.submit(gmc_tools.list_ports)
+        self.after(100, self._check_ports)
+
+    def _check_ports(self):
+        """Fill the serial port chooser once the ports are listed"""
+        if not self._port_future.done():
+            self.after(100, self._check_ports)
+            return
+        self.port_values = [item for item in self._port_future.result()]
+        self.om1.configure(values=self.port_values)
+
     def get_version(self):
         """Get software version from device"""
         self.status.set(gmc_tools.get_version())
@@ -76,10 +91,11 @@ class App(customtkinter.CTk):
         self.status.set(gmc_tools.set_datetime())
 
     def end_program(self):
+        self._port_executor.shutdown(wait=False, cancel_futures=True)
         self.destroy()
         sys.exit(0)
 
-    def get_history(self, data_length=4096) -> str:
+    def get_history(self, data_length=4096):
         """Read all history data from the internal flash memory and write it to a bin file.
         The GQ GMC-500+ Geiger Counter has 1MB Flash Memory.
 
@@ -100,8 +116,10 @@ class App(customtkinter.CTk):
 
         MSB = most significant bit
         LSB = least significant bit
+
+        The pages are read in a background thread and handed to drain_queue, which writes them to the bin file
+        and updates the status.
         :param data_length: int, default 4096
-        :returns: string message
         """
         out_file = f'GMC-500-History-20{gmc_tools.get_datetime()}.bin'  # create filename
         files = [('Binary file', '*.BIN'),
@@ -109,37 +127,67 @@ class App(customtkinter.CTk):
         out_path = asksaveasfilename(filetypes=files, defaultextension='.BIN',
                                      initialdir=os.getcwd(),
                                      initialfile=out_file)
+        if not out_path:  # save dialog was cancelled
+            return
+        self._hist_file = open(out_path, 'wb', buffering=256 * 1024)
         self.status.set('Reading history ...')
-        record = b''
+        self.set_serial_buttons("disabled")
+        self._hist_len = 0
         # set the number of times a page from flash memory will be read
-        num_of_runs = int(DEFAULT_FLASH_SIZE / data_length)
-
-        # send history request to device
-        for i in range(1, num_of_runs + 1):
-            # pack address into 4 bytes, big endian for transmission as MSB to LSB; then clip 1st bye = high byte
-            # struck.pack with ">" uses big endian ordering
-            address = data_length * i
-            ad = struct.pack(">I", address)[1:]
-            # pack data_length into 2 byes, big endian; use all bytes
-            dl = struct.pack(">H", data_length)
-            logger.info(f'{i:>3}: requesting data length: {data_length:5d} (0x{dl[0]:02x}{dl[1]:02x}) address: '
-                        f'{address:5d} (0x{ad[0]:02x}{ad[1]:02x}{ad[2]:02x})')
-            status_msg = f'Reading block {i:>3} of {num_of_runs}'
-            self.status.set(status_msg)
-            self.update()
-            data_page = gmc_tools.send_command(b'<SPIR' + ad + dl + b'>>', data_length)
-            record = record + data_page
-        if record is not None:
-            msg = f"received: {len(record):5d}"
+        self._hist_runs = int(DEFAULT_FLASH_SIZE / data_length)
+        self._hist_q = queue.Queue()
+        self._hist_stop = threading.Event()
+        threading.Thread(target=self._hist_worker, args=(data_length,), daemon=True).start()
+        self.after(30, self.drain_queue)
+
+    def set_serial_buttons(self, state):
+        """Enable or disable all buttons sending commands to the device"""
+        for btn in self.button_frame.serial_btns:
+            btn.configure(state=state)
+
+    def _hist_worker(self, data_length):
+        """Read the history pages from the device and put them on the queue, None marks the end"""
+        pages = gmc_tools.read_flash(data_length, DEFAULT_FLASH_SIZE)
+        try:
+            for page in pages:
+                if self._hist_stop.is_set():  # writing the bin file failed, release the serial port
+                    break
+                self._hist_q.put(page)
+        finally:
+            pages.close()
+            self._hist_q.put(None)
+
+    def drain_queue(self):
+        """Write received history pages to the bin file and show the progress"""
+        finished = True
+        try:
+            while True:
+                try:
+                    page = self._hist_q.get_nowait()
+                except queue.Empty:
+                    finished = False
+                    self.after(30, self.drain_queue)
+                    return
+                if page is None:
+                    break
+                i, data_page = page
+                self._hist_file.write(data_page)
+                self._hist_len += len(data_page)
+                if i % 8 == 0:  # avoid redrawing the status bar for every block
+                    self.status.set(f'Reading block {i:>3} of {self._hist_runs}')
+        finally:
+            if finished:
+                self._hist_stop.set()
+                self.set_serial_buttons("normal")
+                self._hist_file.close()  # may fail again on a full disk, so it runs last
+        if self._hist_len == DEFAULT_FLASH_SIZE:
+            msg = f"received: {self._hist_len:5d}"
             logger.info(msg)
+            self.status.set(f'Data export complete {msg} bytes')
         else:
-            msg = "ERROR: No data received"
+            msg = f"ERROR: Incomplete history, received {self._hist_len} of {DEFAULT_FLASH_SIZE} bytes"
             logger.error(msg)
-        # write history in binary file
-        with open(out_path, 'wb') as f_out:
-            f_out.write(record)
-        self.status.set(f'Data export complete {msg} bytes')
-        return f'\nData export complete {msg} bytes'
+            self.status.set(msg)
 
     def parse_history(self):
         """Load history file, parse and export to csv"""
@@ -153,9 +201,11 @@ class App(customtkinter.CTk):
     def init_ui(self):
         self.title("GMC-500+ Tool")
         self.geometry("600x750")
-        self.status = tk.StringVar()
+        # Setting up variables
+        self.status = customtkinter.StringVar()
         self.status.set(os.getcwd())
-        self.port = tk.StringVar(value="No Port Selected")
+        self.port = customtkinter.StringVar()
+        self.port.set("No Port Selected")
 
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -166,17 +216,13 @@ class App(customtkinter.CTk):
         self.output_frame = MyOutputFrame(self)
         self.output_frame.grid(row=1, column=1, padx=10, pady=(10, 0), sticky="nse")
 
-        # Setting up variables
-        self.status = customtkinter.StringVar()
-        self.status.set(os.getcwd())
-        self.port = customtkinter.StringVar()
-        self.port.set("No Port Selected")
-
-        # Create serial port chooser
-        self.port_values = [item for item in gmc_tools.list_ports()]
+        # Create serial port chooser, the ports are listed in the background
+        self.port_values = ["Scanning…"]
         self.om1 = customtkinter.CTkOptionMenu(master=self, values=self.port_values)
         self.om1.set("Select Port First")
         self.om1.grid(row=0, column=0, padx=20, pady=10, sticky="ew", columnspan=2)
+        self._port_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.scan_ports()
 
         # Create status bar
         self.statusbar = customtkinter.CTkLabel(master=self, textvariable=self.status)
@@ -213,6 +259,9 @@ class MyButtonFrame(customtkinter.CTkFrame):
         super().__init__(master)
 
         # Create buttons
+        self.scan_btn = customtkinter.CTkButton(self, text="Rescan Ports", command=master.scan_ports)
+        self.scan_btn.grid(row=1, column=0, padx=20, pady=10, sticky="w", columnspan=2)
+
         self.set_btn = customtkinter.CTkButton(self, text="Set Port", command=master.set_port)
         self.set_btn.grid(row=2, column=0, padx=20, pady=10, sticky="w", columnspan=2)
 
@@ -240,15 +289,19 @@ class MyButtonFrame(customtkinter.CTkFrame):
         self.hist_btn = customtkinter.CTkButton(self, text="Get History", command=master.get_history)
         self.hist_btn.grid(row=10, column=0, padx=20, pady=10, sticky="w", columnspan=2)
 
-        self.std_btn = customtkinter.CTkButton(self, text="Parse History", command=master.parse_history)
-        self.std_btn.grid(row=11, column=0, padx=20, pady=10, sticky="w", columnspan=2)
+        self.parse_btn = customtkinter.CTkButton(self, text="Parse History", command=master.parse_history)
+        self.parse_btn.grid(row=11, column=0, padx=20, pady=10, sticky="w", columnspan=2)
 
-        self.std_btn = customtkinter.CTkButton(self, text="Power Off", command=master.power_off)
-        self.std_btn.grid(row=12, column=0, padx=20, pady=10, sticky="w", columnspan=2)
+        self.off_btn = customtkinter.CTkButton(self, text="Power Off", command=master.power_off)
+        self.off_btn.grid(row=12, column=0, padx=20, pady=10, sticky="w", columnspan=2)
 
         self.exit_btn = customtkinter.CTkButton(self, text="Quit", command=master.end_program)
         self.exit_btn.grid(row=13, column=0, padx=20, pady=10, sticky="w", columnspan=2)
 
+        # Buttons talking to the device, disabled while the history is read
+        self.serial_btns = [self.pw_btn, self.vn_btn, self.sn_btn, self.cpm_btn, self.vo_btn, self.td_btn,
+                            self.std_btn, self.hist_btn, self.off_btn]
+
 
 if __name__ == "__main__":
     app = App()
@@ -12,6 +12,7 @@ This returns:
   - power_off, power off the device
   - read_datetime, reads date and time from device
   - set_datetime, sets date and time of device
+  - read_flash, reads the history data from the flash memory
   - parse history file and export to csv
 """
 
@@ -21,8 +22,12 @@ import serial
 import serial.tools.list_ports
 import time
 import logging
+import os
+import numpy as np
 import pandas as pd
+from numba import njit
 import sys
+import threading
 
 # set parameters
 DEFAULT_BAUD_RATE = 115200
@@ -34,9 +39,29 @@ DEFAULT_TIMEOUT = 1
 DEFAULT_BIN_FILE = 'log_'
 DEFAULT_CSV_FILE = 'gq-gmc-500-log.csv'
 DEFAULT_FLASH_SIZE = 1_048_576
+DEFAULT_SPIR_PIPELINE = False  # send the next SPIR request before reading the current page
 EOL = '\n'
+SERIAL_ERROR = 'Error occurred! Check serial connection'
+# history save types as (save text, save interval in seconds)
+_SAVE_TYPES = {0: ('history saving deactivated', 0),
+               1: ('Every Second', 1),
+               2: ('Every Minute', 60),
+               3: ('Every Hour', 3600),
+               4: ('Every Second if exceeding threshold', 1),
+               5: ('Every Minute if exceeding threshold', 60)}
+# kind of record following the 0x55 0xAA sequence marker, looked up by the tag code
+_NO_RECORD = 0
+_TIMESTAMP = 1  # tag 0, date and time follow
+_NEW_TIMESTAMP = 2  # tag 5, date and time follow after 4 bytes
+_DOUBLE_BYTE = 3  # tag 1, count exceeding 255 follows as two bytes
+_MARKER_KIND = np.zeros(256, dtype=np.int8)
+_MARKER_KIND[0] = _TIMESTAMP
+_MARKER_KIND[5] = _NEW_TIMESTAMP
+_MARKER_KIND[1] = _DOUBLE_BYTE
 
 default_port: str = DEFAULT_PORT
+_port: serial.Serial | None = None  # serial port kept open between commands
+_port_lock = threading.Lock()  # commands from the UI and the history reader must not interleave
 
 # Crate and configure logger, append logs on every run
 logging.basicConfig(filename='geigerlog.log', filemode='a', format='%(asctime)s %(message)s')
@@ -61,28 +86,40 @@ def test_serial(test_port=default_port, ) -> str:
     return msg
 
 
+def _get_port() -> serial.Serial:
+    """Return the open serial port, open it on first use or when the default port has changed"""
+    global _port
+    if _port is None or not _port.is_open or _port.port != default_port:
+        _close_port()
+        _port = serial.Serial(default_port, DEFAULT_BAUD_RATE, bytesize=DEFAULT_DATA_BITS, timeout=DEFAULT_TIMEOUT)
+    return _port
+
+
+def _close_port():
+    """Close the cached serial port, the next command opens it again"""
+    global _port
+    if _port is not None:
+        _port.close()
+    _port = None
+
+
 def send_command(command: bytes, b_len: int):
     """
-    Send a command to the device
+    Send a command to the device, the serial port is kept open between commands
     :param command: as bytes
     :param b_len: length of bytes
-    :returns: Error message if not successful
-    """
-    global default_port
-    ser_test = test_serial(default_port)
-    if "Error" in ser_test:
-        print(ser_test[7:])
-        logger.error('Error occurred! Check serial connection')
-        return f'Error occurred! Check serial connection'
-    else:
-        with serial.Serial(default_port, DEFAULT_BAUD_RATE, bytesize=DEFAULT_DATA_BITS, timeout=DEFAULT_TIMEOUT) as ser:
-            try:
-                ser.write(command)
-                ans = ser.read(b_len)
-            except FileNotFoundError as e:
-                logger.error(f'Error {e}')
-                return f'Error {e}'
-            return ans
+    :returns: answer as bytes, empty if not successful (callers report SERIAL_ERROR)
+    """
+    with _port_lock:
+        try:
+            ser = _get_port()
+            ser.reset_input_buffer()
+            ser.write(command)
+            return ser.read(b_len)
+        except serial.SerialException as e:
+            logger.error('Error occurred! Check serial connection: %s', e)
+            _close_port()
+            return b''
 
 
 def list_ports(symlinks=True) -> list:
@@ -101,7 +138,7 @@ def list_ports(symlinks=True) -> list:
             if item.description == "USB Serial":
                 global default_port
                 default_port = f'/dev/{item.name}'
-                logger.info(f'Default Port set to: {default_port}')
+                logger.info('Default Port set to: %s', default_port)
         ports = ['/dev/' + item.name for item in port_list]
     return ports
 
@@ -111,10 +148,10 @@ def power_up() -> str:
     try:
         send_command(b'<POWERON>>', 0)
         msg = f'Device activated'
-        logger.info(f'Device activated')
+        logger.info('Device activated')
     except FileNotFoundError as e:
         msg = f'Device not found, check serial port first'
-        logger.warning(f'Device not found, check serial port first.')
+        logger.warning('Device not found, check serial port first.')
     return msg
 
 
@@ -124,6 +161,8 @@ def get_version() -> str:
     :returns: Model and version as string
     """
     ver = send_command(b'<GETVER>>', 15)
+    if not ver:
+        return SERIAL_ERROR
     return f'Geiger Counter Version: {ver.decode()}'
 
 
@@ -133,6 +172,8 @@ def get_serial() -> str:
     :returns: Sertial number as string
     """
     serial = send_command(b'<GETSERIAL>>', 7)
+    if not serial:
+        return SERIAL_ERROR
     serial_number = serial.replace(b'\r', b'').decode()
     return f'The serial number is: {serial_number}'
 
@@ -143,7 +184,9 @@ def get_cpm() -> str:
     :returns: Counts per minute as string
     """
     raw_cpm = send_command(b'<GETCPM>>', 4)
-    cpm = int(raw_cpm[2:4].hex(), 16)
+    if len(raw_cpm) < 4:
+        return SERIAL_ERROR
+    cpm = int.from_bytes(raw_cpm[2:4], 'big')
     return f'Current CPM are: {cpm}'
 
 
@@ -153,6 +196,8 @@ def get_voltage() -> str:
     :returns:  voltage of battery as string.
     """
     voltage = send_command(b'<GETVOLT>>', 5).decode()
+    if not voltage:
+        return SERIAL_ERROR
     return f'Battery voltage: {voltage}'
 
 
@@ -171,6 +216,8 @@ def read_datetime() -> str:
     :returns: String with date and time from device
     """
     raw_datetime = send_command(b'<GETDATETIME>>', 7)
+    if len(raw_datetime) < 7:
+        return SERIAL_ERROR
     # short version using the struct library
     # struct.unpack() converts the strings of binary representations to their original form according to the
     # specified format. The return type is always a tuple.
@@ -192,10 +239,65 @@ def set_datetime() -> str:
     minute = int(today.strftime("%M"))
     second = int(today.strftime("%S"))
     cmd = struct.pack('>BBBBBB', year, month, day, hour, minute, second)
-    send_command(b'<SETDATETIME' + cmd + b'>>', 1)
+    if not send_command(b'<SETDATETIME' + cmd + b'>>', 1):
+        return SERIAL_ERROR
     return f'local date and time are:  {day:02d}-{month:02d}-{year:02d}  {hour:02d}:{minute:02d}:{second:02d}'
 
 
+def _spir_command(page: int, data_length: int) -> bytes:
+    """
+    Create the SPIR command to read one page of history data from the flash memory
+    :param page: page number, starting with 1
+    :param data_length: number of bytes per page
+    :returns: command as bytes
+    """
+    # pack address into 4 bytes, big endian for transmission as MSB to LSB; then clip 1st bye = high byte
+    # struck.pack with ">" uses big endian ordering
+    address = data_length * (page - 1)
+    ad = struct.pack(">I", address)[1:]
+    # pack data_length into 2 byes, big endian; use all bytes
+    dl = struct.pack(">H", data_length)
+    logger.info('%3d: requesting data length: %5d (0x%02x%02x) address: %5d (0x%02x%02x%02x)',
+                page, data_length, dl[0], dl[1], address, ad[0], ad[1], ad[2])
+    return b'<SPIR' + ad + dl + b'>>'
+
+
+def read_flash(data_length=4096, flash_size=DEFAULT_FLASH_SIZE, pipeline=DEFAULT_SPIR_PIPELINE):
+    """
+    Read the history data from the flash memory page by page over the open serial port.
+
+    With pipeline the request for the next page is sent before the current page is read, so the device can
+    transmit the pages back-to-back. Only use it if the firmware does not drop queued commands.
+    :param data_length: number of bytes per request, normally not exceeding 4096
+    :param flash_size: size of the flash memory in bytes
+    :param pipeline: send the next request before reading the current page
+    :returns: generator of (page number, page data), stops at the first serial error or incomplete page
+    """
+    num_of_runs = int(flash_size / data_length)
+    # hold the port for the whole read, other commands would mix their answers into the history pages
+    with _port_lock:
+        try:
+            ser = _get_port()
+            ser.reset_input_buffer()
+            if pipeline:
+                ser.write(_spir_command(1, data_length))
+            for i in range(1, num_of_runs + 1):
+                if not pipeline:
+                    ser.reset_input_buffer()  # drop late bytes of an earlier answer
+                    ser.write(_spir_command(i, data_length))
+                elif i < num_of_runs:
+                    ser.write(_spir_command(i + 1, data_length))
+                data_page = ser.read(data_length)
+                if len(data_page) != data_length:
+                    # the rest of the page would arrive late and shift all following pages
+                    logger.error('Page %d incomplete, received %d of %d bytes', i, len(data_page), data_length)
+                    return
+                yield i, data_page
+        except serial.SerialException as e:
+            logger.error('Error %s', e)
+            _close_port()
+
+
 def get_datetime() -> str:
     """
     Get current system date and time and return it
@@ -220,56 +322,91 @@ def hexlify(data) -> str:
     return ' '.join(f'{c:0>2X}' for c in data)
 
 
-def create_record_time(data):
-    """
-    Create timestamp from part of bin file data and return timestamp in datetime format.
-    :param data: a slice from the bin file
-    :return: record_time (datetime)
-    """
-    year = data[3]  # year in hex without thousands
-    month = data[4]  # month in hex
-    day = data[5]  # day in hex
-    hour = data[6]  # hours in hex
-    minute = data[7]  # minutes in hex
-    second = data[8]  # seconds in hex
-    # 0x55 and 0XAA are the end of the sequence marker
-    # create timestamp and append to list
-    rec_time = f"20{year:02d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
-    timestamp = datetime.datetime.strptime(rec_time, "%Y-%m-%d %H:%M:%S")
-    return timestamp
-
-
-def get_save_type(save_type) -> list:
+def get_save_type(save_type) -> tuple:
     """
     Determine the saved data type and return it as string.
     Saved data types are every second, every minute or every hour.\n
     The respective intervals are 1s, 60s, and 3600s.
     :param save_type:
-    :return: list(save_type, save_interval)
-    """
-    if save_type == 0:
-        save_text = 'history saving deactivated'
-        save_intval = 0
-    elif save_type == 1:
-        save_text = 'Every Second'
-        save_intval = 1
-    elif save_type == 2:
-        save_text = 'Every Minute'
-        save_intval = 60
-    elif save_type == 3:
-        save_text = 'Every Hour'
-        save_intval = 3600
-    elif save_type == 4:
-        save_text = 'Every Second if exceeding threshold'
-        save_intval = 1
-    elif save_type == 5:
-        save_text = 'Every Minute if exceeding threshold'
-        save_intval = 60
-    else:
+    :return: tuple(save_type, save_interval)
+    """
+    if save_type not in _SAVE_TYPES:
         save_text = f'Error false save interval: {save_type} (allowed is: 0, 1, 2, 3, 4, 5)'
         print(save_text)
         sys.exit(1)
-    return [save_text, save_intval]
+    return _SAVE_TYPES[save_type]
+
+
+@njit(cache=True, boundscheck=False)
+def _complete_rows(done, rows, first_row, offset, save_type, out_offset, out_min, out_type) -> int:
+    """Set timestamp offset, minutes since the timestamp and save type for the newly completed rows"""
+    for row in range(done, rows):
+        out_offset[row] = offset
+        out_min[row] = row - first_row  # every row is one minute after the previous row
+        out_type[row] = save_type
+    return rows
+
+
+@njit(cache=True, boundscheck=False)
+def _scan_history(buf, markers, out_offset, out_min, out_type, out_cps) -> int:
+    """
+    Scan the raw history data and fill the preallocated output arrays, one row per 60 counts.
+
+    Only the marker positions are visited, the counts in between are copied as a block. Every row gets the offset
+    of the last timestamp record, the number of minutes since that record and the save type of the record.
+    :param buf: history data as uint8 array
+    :param markers: offsets of all 0x55 0xAA sequence markers with a known tag code
+    :param out_offset: int64 array for the offsets of the timestamp records
+    :param out_min: int32 array for the minutes since the timestamp
+    :param out_type: uint8 array for the save type codes
+    :param out_cps: 2D uint16 array (rows, 60) for the counts per second
+    :return: number of rows filled
+    """
+    data_length = buf.shape[0]
+    samples = out_cps.reshape(-1)  # counts are stored consecutively, 60 per row
+    n = 0  # number of counts stored
+    first_row = 0  # first row after the last timestamp
+    done = 0  # number of rows with timestamp and save type set
+    pos = 0  # first byte not parsed yet
+    offset = 0
+    save_type = 0
+    store_data = False  # only store data if we have a date and time
+    for m in markers:
+        if m < pos:  # marker is part of a record that has been parsed already
+            continue
+        if store_data:
+            samples[n:n + m - pos] = buf[pos:m]
+            n += m - pos
+            done = _complete_rows(done, n // 60, first_row, offset, save_type, out_offset, out_min, out_type)
+        kind = _MARKER_KIND[buf[m + 2]]
+        if kind != _DOUBLE_BYTE:  # date/timestamp follows
+            if kind == _NEW_TIMESTAMP:
+                m += 4
+            if m + 11 >= data_length:
+                pos = data_length
+                break
+            n -= n % 60  # start a new row with the new timestamp
+            first_row = n // 60
+            offset = m  # date and time are decoded from the offset after scanning
+            save_type = buf[m + 11]
+            store_data = True
+            pos = m + 12  # jump to first position after date and time
+        else:
+            # double data byte in the form [55][AA][01][DH][DL] represents data
+            # whose value exceeded 255 and needs two bytes
+            if m + 4 >= data_length:
+                pos = data_length
+                break
+            if store_data:
+                samples[n] = np.int32(buf[m + 3]) * 256 + buf[m + 4]
+                n += 1
+                done = _complete_rows(done, n // 60, first_row, offset, save_type, out_offset, out_min, out_type)
+            pos = m + 5
+    if store_data and pos < data_length:
+        samples[n:n + data_length - pos] = buf[pos:]
+        n += data_length - pos
+        done = _complete_rows(done, n // 60, first_row, offset, save_type, out_offset, out_min, out_type)
+    return n // 60
 
 
 def bin_to_csv(in_file='20231007_17_19_34.bin', out_file='20231007_17_19_34.csv'):
@@ -282,103 +419,51 @@ def bin_to_csv(in_file='20231007_17_19_34.bin', out_file='20231007_17_19_34.csv'
     :param out_file:
     :return:
     """
-    global record_timestamp, save_interval, new_timestamp, save_txt, record_time
-    global store_data
-    store_data = False
-    # Create empty dataframe with column names to store parsed data
-    column_names = ['DateTime', 'Type', 'CPM'] + [f'# {x} CPS' for x in range(1, 61)]
-    parsed_df = pd.DataFrame(columns=column_names)
-    # Read bin file in chunks
-    logger.info(f'Reading file {in_file} for parsing')
-    with open(in_file, 'rb') as file:
-        # try reading all data
-        chunk = file.read()
-    data_length = len(chunk)  # parse all data in one chunk
-    record = chunk
-    i = 0  # counter for byte number
-    counter_per_minute = 0  # counter for counts per minute read
-    lst = []  # create empty list for data rows
-    cps = 0  # create counter for counts per second
-    # Parse data, if marker found, get timestamp, then continue to collect and add 60 counts to list
-    # if one minute is full, add list to new row in dataframe. empty list. add 1 minute to timestamp and add
-    # timestamp, save interval text and next 60 counts to list.
-    # Device creates a timestamp every 180 seconds.
-    while i < data_length:
-        if record[i] == 0x55:  # read byte and check if it is start of a sequence marker
-            if record[i + 1] == 0xaa:
-                if record[i + 2] == 0 or record[i + 2] == 5:  # check for enumeration code that date/timestamp follows
-                    if record[i + 2] == 5:  # we have a new timestamp, need to empy the list
-                        i += 4
-                        record_time = create_record_time(record[i:i + 10])  # get the timestamp
-                        cps = 0  # reset counts per second
-                        lst = []
-                        new_timestamp = True
-                    else:
-                        record_time = create_record_time(record[i:i + 10])  # get the timestamp
-                        new_timestamp = True
-                    if len(lst) == 2:
-                        lst = []
-                    lst.append(record_time)
-                    store_data = True  # only store data if we have a date and time
-                    # check history saving mode 1s, 60s or 1 hour
-                    save_type = record[i + 11]
-                    save_txt = get_save_type(save_type)[0]
-                    save_interval = get_save_type(save_type)[1]
-                    lst.append(save_txt)
-                    i += 12  # jump to first position after date and time
-                elif record[i + 2] == 1:
-                    # double data byte in the form [55][AA][01][DH][DL] represents data
-                    # whose value exceeded 255 and needs two bytes
-                    print(f'double data stuff: {record[i:i + 12]}')
-                    msb = record[i + 3]  # most significant bit
-                    lsb = record[i + 4]  # least significant bit
-                    cpm = msb * 256 + lsb
-                    cpmtime = datetime.datetime.fromtimestamp(
-                        record_time + counter_per_minute * save_interval).strftime(
-                        '%Y-%m&d %H:%M:%S')
-                    record_string = f' {i:5d}, {cpmtime:19s}, {cpm:3d}'
-                    print(f'{record_string}, double byte data')
-                    i += 4
-                    counter_per_minute += 1
-            else:  # 0x55 is genuine cpm, no tag code
-                cpx = record[i]
-                if store_data:
-                    lst.append(i)
-                i += 1
-                cps += 1
-        if store_data:
-            lst.append(record[i])
-            cps += 1
-        i += 1
-        # If 60s of data have been parsed, add list to dataframe and start new empty list.
-        if cps == 60:
-            lst.insert(2, sum(lst[2:62]))  # add counts per minute
-            parsed_df.loc[len(parsed_df)] = lst
-            cps = 0
-            lst = []
-            # add one minute to timestamp
-            record_time_new = record_time + datetime.timedelta(minutes=1.0)
-            if len(lst) != 0:
-                print(f'list is {len(lst)} long.')
-            elif len(lst) == 0:
-                record_time = record_time_new
-                lst.append(record_time)
-                lst.append(save_txt)
-        # The 0xFF (255) data indicates an area of the history buffer that has no data recorded -> end loop
-        if record[i] == 255 and record[i + 1] == 255 and record[i + 2] == 255:
-            write_csv(final_df=parsed_df, out_file=out_file)
-            logger.info(f'Parsing complete, csv export complete.')
-            return f'Finished parsing, csv export done.'
+    logger.info('Reading file %s for parsing', in_file)
+    # map the file into memory, the OS reads the pages when the data is scanned; empty files cannot be mapped
+    if os.path.getsize(in_file) == 0:
+        record = np.zeros(0, dtype=np.uint8)
+    else:
+        record = np.memmap(in_file, dtype=np.uint8, mode='r')
+    # The 0xFF (255) data indicates an area of the history buffer that has no data recorded -> cut it off
+    empty = np.flatnonzero((record[:-2] == 0xff) & (record[1:-1] == 0xff) & (record[2:] == 0xff))
+    if len(empty):
+        record = record[:empty[0]]
+    # 0x55 0xAA followed by a known tag code marks a timestamp or a double data byte
+    markers = np.flatnonzero((record[:-2] == 0x55) & (record[1:-1] == 0xaa) & (_MARKER_KIND[record[2:]] != _NO_RECORD))
+    # Every row holds at least 60 bytes, preallocate the output for the worst case
+    max_rows = len(record) // 60 + 1
+    out_offset = np.zeros(max_rows, dtype=np.int64)
+    out_min = np.zeros(max_rows, dtype=np.int32)
+    out_type = np.zeros(max_rows, dtype=np.uint8)
+    out_cps = np.zeros((max_rows, 60), dtype=np.uint16)  # two bytes hold the double data byte counts too
+    rows = _scan_history(record, markers, out_offset, out_min, out_type, out_cps)
+    # Build the dataframe in one go from the scanned rows
+    # Decode all timestamp records at once, the year is stored without thousands
+    offsets = out_offset[:rows]
+    record_time = pd.to_datetime({'year': record[offsets + 3].astype(np.int64) + 2000,
+                                  'month': record[offsets + 4],
+                                  'day': record[offsets + 5],
+                                  'hour': record[offsets + 6],
+                                  'minute': record[offsets + 7],
+                                  'second': record[offsets + 8]})
+    save_txt = {save_type: get_save_type(save_type)[0] for save_type in np.unique(out_type[:rows])}
+    columns = {'DateTime': record_time + pd.to_timedelta(out_min[:rows], unit='min'),
+               'Type': pd.Series(out_type[:rows]).map(save_txt),
+               'CPM': out_cps[:rows].sum(axis=1)}
+    columns.update({f'# {x} CPS': out_cps[:rows, x - 1] for x in range(1, 61)})
+    parsed_df = pd.DataFrame(columns)
     write_csv(final_df=parsed_df, out_file=out_file)
+    logger.info('Parsing complete, csv export complete.')
+    return f'Finished parsing, csv export done.'
 
 
 def write_csv(final_df, out_file):
     """Write the parsed data to a csv file"""
-    # Add some text to the first row before creating the csv file
-    header_text = """GMC-500+ Data Tool
-    {}"""
-    with open(out_file, 'w') as fp:
-        fp.write(header_text.format(final_df.to_csv(index=False)))
+    # Add some text to the first row, then let pandas write the csv data directly to the file
+    with open(out_file, 'w', buffering=1 << 20) as fp:
+        fp.write("GMC-500+ Data Tool\n    ")
+        final_df.to_csv(fp, index=False, lineterminator='\n')
     return f'Parsed BIN file and wrote data to file.'
 
 